@@ -1,24 +1,81 @@
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from heapq import merge
+from itertools import accumulate, groupby
+from struct import unpack_from
+import argparse
+import json
+import locale
+import math
+import mmap
 import os
+import pickle
 import re
+import shutil
+import sys
+import time
 
-# Dictionary to store the index of words in documents.
-dic = defaultdict(set)
+# Dictionary to store the index of words in documents. Each word maps to a sorted
+# array('I') of document IDs rather than a set of file names.
+dic = {}
+doc_names = []  # File name of every document ID, None for documents that were removed.
+doc_ids = {}  # Document ID of every indexed file name.
+doc_words = {}  # Sorted words of every indexed document ID, used to remove its postings and find its positions.
+indexed_files = {}  # Modification time and size of every document at the time it was indexed.
+doc_offsets = {}  # Offset and length of every document's content inside the packed store.
+position_offsets = {}  # Offset and length of every document ID's word positions inside the positions store.
+store = None  # Read-only memory map of the packed store, opened after indexing.
+positions_store = None  # Read-only memory map of the positions store, only read by phrase queries.
 path = './documents'  # Directory containing all documents to be indexed and searched.
+index_path = './index.pkl'  # Saved index, loaded at startup instead of re-reading every document.
+pack_path = './documents.pack'  # Content of all indexed documents packed into a single file.
+positions_path = './positions.pack'  # Word positions of all indexed documents, kept out of the loaded index.
+INDEX_VERSION = 6  # Bumped whenever the layout of the saved index changes.
+POSITION_SIZE = array('I').itemsize  # Bytes per value in the positions store.
+workers = 1  # Number of processes used to read documents, set with --workers.
+CHUNK_SIZE = 1 << 20  # Characters read at a time, so large documents never have to fit in memory.
+COMPACT_RATIO = 0.5  # Share of removed documents or dead bytes in a store above which they are compacted.
 
 def main():
     # Main function to control the menu-driven interaction with the user.
-    readAllDocument()  # Reads all documents and indexes them before user interaction.
+    global workers
+    parser = argparse.ArgumentParser(description="Search text documents by name or by word.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes used to read documents (default: 1)")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="answer the queries in FILE, one per line ('-' for stdin), instead of showing the menu")
+    parser.add_argument('--output', metavar='FILE',
+                        help="write batch results to FILE instead of stdout")
+    args = parser.parse_args()
+    workers = max(1, args.workers)
+    loadIndex()
+    # Indexes the documents that were added or changed since the saved index before user interaction.
+    if readAllDocument(incremental=True):
+        saveIndex()
+    if args.batch:
+        # Only the files opened here are closed, stdin and stdout are left open.
+        with ExitStack() as files:
+            queries = sys.stdin if args.batch == '-' else files.enter_context(open(args.batch, 'r'))
+            output = files.enter_context(open(args.output, 'w')) if args.output else sys.stdout
+            runBatch(queries, output)
+            output.flush()
+        return
     while True:
         os.system('cls')  # Clears the console 
         print("1. Search document")
         print("2. Search word")
+        print("3. Refresh index")
         print("e. Exit")
         op = input("Choose an option: ")
         if op == '1':
             searchDocument()  # Searches for and displays a document by its name.
         elif op == '2':
             searchWord()  # Searches for documents that contain a specific word.
+        elif op == '3':
+            refreshIndex()  # Picks up documents added, changed or deleted while running.
         elif op == 'e':
             break  # Exit the program.
         else:
@@ -28,40 +85,458 @@ def main():
 def searchDocument():
     # Function to search and display the content of a document by its name.
     name = input("Enter name of document : ")
-    
-    files = os.listdir(path)  # Retrieves the list of all document names in the directory.
-    if name in files:
-        file_path = os.path.join(path, name)
-        with open(file_path, 'r') as file:
-            content = file.read()
-            print(content)  # Displays the content of the specified document.
+
+    content = getDocument(name)  # Looks the document up in the packed store instead of the directory.
+    if content is not None:
+        print(str(content, locale.getpreferredencoding(False)))  # Displays the content of the specified document.
     else:
         print(f"Document '{name}' not found in '{path}'.")
 
+def getDocument(name):
+    # Function to return the content of an indexed document as a memoryview slice of
+    # the packed store, without copying it, or None if there is no such document.
+    entry = doc_offsets.get(name)
+    if entry is None:
+        return None
+    offset, length = entry
+    if length == 0:
+        return memoryview(b'')
+    return memoryview(store)[offset:offset + length]
+
 def searchWord():
-    # Function to search for documents that contain a specific word.
-    word = input("Enter word to search : ")
-    word = re.sub(r'[^\w\s]', '', word)
-    if word.lower() in dic:
-        print(f"{word} is in these files : {dic[word.lower()]}")  # Display documents containing the word.
+    # Function to search for documents that contain a specific word. Several words can be
+    # combined with AND / OR (AND when no operator is given) and "quoted words" match a phrase.
+    query = input("Enter word to search : ")
+    files = runQuery(query)
+    if files:
+        print(f"{query} is in these files : {set(files)}")  # Display documents containing the word.
     else:
-        print(f"{word} is not found in any file.")
+        print(f"{query} is not found in any file.")
     return 0
 
-def readAllDocument():
+def runQuery(query):
+    # Function to evaluate a query against the index and return the matching file names.
+    # Operators are applied from left to right.
+    result = None
+    op = 'AND'
+    for token in re.findall(r'"[^"]*"|\S+', query):
+        if token in ('AND', 'OR'):
+            op = token
+            continue
+        if token.startswith('"'):
+            postings = searchPhrase(token.strip('"'))
+        else:
+            word = re.sub(r'[^\w\s]', '', token).lower()
+            postings = dic.get(word, array('I'))
+        if result is None:
+            result = postings
+        elif op == 'AND':
+            result = intersectPostings(result, postings)
+        else:
+            result = unionPostings(result, postings)
+        op = 'AND'
+    return [doc_names[doc_id] for doc_id in result or ()]
+
+def runBatch(queries, output):
+    # Function to answer queries without the menu, writing one JSON line per query, and
+    # to report throughput and latency statistics on stderr once all of them are done.
+    latencies = []
+    start = time.perf_counter()
+    for line in queries:
+        query = line.strip()
+        if not query:
+            continue
+        query_start = time.perf_counter()
+        files = runQuery(query)
+        latency = time.perf_counter() - query_start
+        latencies.append(latency)
+        output.write(json.dumps({'query': query, 'files': files, 'latency_ms': round(latency * 1000, 3)}) + '\n')
+    total = time.perf_counter() - start
+    latencies.sort()
+    count = len(latencies)
+    print(f"Queries: {count} in {total:.3f} s ({count / total if total else 0:.1f} queries/s)", file=sys.stderr)
+    if count:
+        print(f"Latency ms: mean {sum(latencies) / count * 1000:.3f}", end='', file=sys.stderr)
+        for percent in (50, 95, 99):
+            print(f", p{percent} {latencies[min(count - 1, count * percent // 100)] * 1000:.3f}", end='', file=sys.stderr)
+        print(f", max {latencies[-1] * 1000:.3f}", file=sys.stderr)
+
+def searchPhrase(phrase):
+    # Function to find the documents containing the words of a phrase next to each other,
+    # using the positions recorded while indexing. Short words aren't indexed, but they
+    # still count when working out where the following words have to be.
+    words = re.sub(r'[^\w\s]', '', phrase).lower().split()
+    terms = [(offset, word) for offset, word in enumerate(words) if len(word) > 3]
+    if not terms or any(word not in dic for offset, word in terms):
+        return array('I')
+    candidates = dic[terms[0][1]]
+    for offset, word in terms[1:]:
+        candidates = intersectPostings(candidates, dic[word])
+    result = array('I')
+    for doc_id in candidates:
+        first_offset, first_word = terms[0]
+        others = [(offset - first_offset, set(getPositions(word, doc_id))) for offset, word in terms[1:]]
+        for start in getPositions(first_word, doc_id):
+            if all(start + distance in found for distance, found in others):
+                result.append(doc_id)
+                break
+    return result
+
+def getPositions(word, doc_id):
+    # Function to read the positions of a word inside one document from the positions store.
+    # A document's entry starts with where every word's positions start, in the sorted order
+    # of its words in doc_words, and where the last one ends, followed by the positions.
+    offset = position_offsets[doc_id][0]
+    words = doc_words[doc_id]
+    start, end = unpack_from('II', positions_store, offset + bisect_left(words, word) * POSITION_SIZE)
+    base = offset + (len(words) + 1) * POSITION_SIZE
+    found = array('I')
+    found.frombytes(positions_store[base + start * POSITION_SIZE:base + end * POSITION_SIZE])
+    return found
+
+def intersectPostings(a, b):
+    # Function to intersect two sorted postings lists. Skip pointers every sqrt(n) entries
+    # let the walk jump over runs of IDs that can't be in the other list.
+    result = array('I')
+    skip_a = int(math.sqrt(len(a))) or 1
+    skip_b = int(math.sqrt(len(b))) or 1
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            result.append(a[i])
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            if i + skip_a < len(a) and a[i + skip_a] <= b[j]:
+                while i + skip_a < len(a) and a[i + skip_a] <= b[j]:
+                    i += skip_a
+            else:
+                i += 1
+        else:
+            if j + skip_b < len(b) and b[j + skip_b] <= a[i]:
+                while j + skip_b < len(b) and b[j + skip_b] <= a[i]:
+                    j += skip_b
+            else:
+                j += 1
+    return result
+
+def unionPostings(a, b):
+    # Function to merge two sorted postings lists in a single pass, keeping IDs found in both once.
+    return array('I', (doc_id for doc_id, _ in groupby(merge(a, b))))
+
+def refreshIndex():
+    # Function to bring the index up to date with the documents directory.
+    if readAllDocument(incremental=True):
+        saveIndex()
+        print("Index updated.")
+    else:
+        print("Index is already up to date.")
+
+def readAllDocument(incremental=False):
     # Function to read and index all documents in the specified directory.
-    files = os.listdir(path)  # Retrieves all document file names in the directory.
+    # In incremental mode only documents added or changed since they were last indexed are read,
+    # and the postings of deleted documents are removed. Returns True if the index changed.
+    files = scanDocuments()  # Retrieves all document file names in the directory.
+    if not incremental:
+        dic.clear()
+        doc_names.clear()
+        doc_ids.clear()
+        doc_words.clear()
+        indexed_files.clear()
+        doc_offsets.clear()
+        position_offsets.clear()
+    changed = False
+    for f_path in list(indexed_files):
+        if files.get(f_path) != indexed_files[f_path]:
+            removeDocument(f_path)  # Deleted or modified since it was indexed.
+            changed = True
+    pending = []
     for f_path in files:
-        file_path = os.path.join(path, f_path)
-        with open(file_path, 'r') as file:
-            content = file.read()
-            # Clean the content to remove punctuation using regular expressions.
-            cleaned_content = re.sub(r'[^\w\s]', '', content)
-            # Convert content to lowercase and split it into words, ignoring short words.
-            words = [word.lower() for word in cleaned_content.split() if len(word) > 3]
+        if f_path not in indexed_files:
+            # New documents always get a larger ID than every indexed one, so their
+            # postings can be appended without breaking the sorted order.
+            doc_ids[f_path] = len(doc_names)
+            doc_names.append(f_path)
+            pending.append((doc_ids[f_path], f_path))
+    closeStore()  # Neither store can be extended while it is mapped on every platform.
+    with open(positions_path, 'ab' if position_offsets else 'wb') as positions_file:
+        if workers > 1 and len(pending) > 1:
+            readDocumentsParallel(pending, positions_file)
+        else:
+            for doc_id, f_path in pending:
+                indexDocument(doc_id, f_path, positions_file)
+    if pending or not doc_offsets:
+        packDocuments(pending)
+    for doc_id, f_path in pending:
+        indexed_files[f_path] = files[f_path]
+        changed = True
+    if changed and needsCompaction():
+        compactIndex()
+    openStore()
+    return changed
+
+def needsCompaction():
+    # Function to tell whether removed documents take up too much of the document IDs
+    # or of the stores, which all only grow while documents are modified.
+    removed = len(doc_names) - len(doc_ids)
+    pack_size = os.path.getsize(pack_path)
+    dead_bytes = pack_size - sum(length for offset, length in doc_offsets.values())
+    positions_size = os.path.getsize(positions_path)
+    dead_positions = positions_size - sum(length for offset, length in position_offsets.values())
+    return (removed > COMPACT_RATIO * len(doc_names) or dead_bytes > COMPACT_RATIO * pack_size
+            or dead_positions > COMPACT_RATIO * positions_size)
+
+def compactIndex():
+    # Function to drop removed documents for good: the content and the word positions of
+    # the indexed documents are copied to new stores without the dead bytes, and the document
+    # IDs are renumbered without gaps. IDs keep their order, so every postings list stays sorted.
+    closeStore()
+    live = [(doc_id, f_path) for doc_id, f_path in enumerate(doc_names) if f_path is not None]
+    new_ids = {doc_id: new_id for new_id, (doc_id, f_path) in enumerate(live)}
+    tmp_path = pack_path + '.tmp'
+    with open(pack_path, 'rb') as old_pack, open(tmp_path, 'wb') as pack:
+        for doc_id, f_path in live:
+            doc_offsets[f_path] = copyRange(old_pack, pack, *doc_offsets[f_path])
+    os.replace(tmp_path, pack_path)
+    tmp_path = positions_path + '.tmp'
+    with open(positions_path, 'rb') as old_positions, open(tmp_path, 'wb') as positions_file:
+        moved = {new_ids[doc_id]: copyRange(old_positions, positions_file, *position_offsets[doc_id])
+                    for doc_id, f_path in live}
+    os.replace(tmp_path, positions_path)
+    position_offsets.clear()
+    position_offsets.update(moved)
+    for word, postings in dic.items():
+        dic[word] = array('I', [new_ids[doc_id] for doc_id in postings])
+    remapped = {new_ids[doc_id]: words for doc_id, words in doc_words.items()}
+    doc_words.clear()
+    doc_words.update(remapped)
+    doc_names[:] = [f_path for doc_id, f_path in live]
+    for new_id, f_path in enumerate(doc_names):
+        doc_ids[f_path] = new_id
+
+def copyRange(source, target, offset, length):
+    # Function to copy length bytes at offset in source to the end of target, returning
+    # their new offset and length.
+    source.seek(offset)
+    new_offset = target.tell()
+    left = length
+    while left > 0:
+        chunk = source.read(min(left, CHUNK_SIZE))
+        if not chunk:
+            break  # The store was cut short, the index is rebuilt from scratch when reloaded.
+        target.write(chunk)
+        left -= len(chunk)
+    return new_offset, length
+
+def packDocuments(pending):
+    # Function to append the content of newly indexed documents to the packed store.
+    # Space left by removed or modified documents is reclaimed by compactIndex().
+    closeStore()  # The file can't be extended while it is mapped on every platform.
+    with open(pack_path, 'ab' if doc_offsets else 'wb') as pack:
+        for doc_id, f_path in pending:
+            with open(os.path.join(path, f_path), 'rb') as file:
+                offset = pack.tell()
+                shutil.copyfileobj(file, pack, CHUNK_SIZE)
+                doc_offsets[f_path] = (offset, pack.tell() - offset)
+
+def openStore():
+    # Function to memory-map the packed store and the positions store so documents and
+    # word positions can be read by slicing.
+    global store, positions_store
+    closeStore()
+    store = mapFile(pack_path)
+    positions_store = mapFile(positions_path)
+
+def mapFile(file_path):
+    # Function to map a whole file read-only, or return None when it is empty.
+    with open(file_path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size > 0:  # An empty file can't be mapped.
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return None
+
+def closeStore():
+    # Function to release the memory maps of the packed store and the positions store.
+    global store, positions_store
+    if store is not None:
+        store.close()
+        store = None
+    if positions_store is not None:
+        positions_store.close()
+        positions_store = None
+
+def readDocumentsParallel(pending, positions_file):
+    # Function to index documents with a pool of processes. The file list is split into
+    # shards, each worker builds a partial index of its shard and the parts are merged here.
+    shard_count = min(len(pending), workers * 4)  # A few shards per worker keeps them all busy.
+    size = -(-len(pending) // shard_count)
+    # Shards hold consecutive document IDs and map() returns them in order, so merging
+    # only has to append to each postings list.
+    shards = [pending[i:i + size] for i in range(0, len(pending), size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial_dic, partial_positions, partial_words in executor.map(indexShard, [path] * len(shards), shards):
+            for word, postings in partial_dic.items():
+                addPostings(word, postings)
+            for doc_id, words in partial_words.items():
+                doc_words[doc_id] = tuple(sys.intern(word) for word in words)
+                writePositions(doc_id, partial_positions[doc_id], positions_file)
+
+def indexShard(directory, shard):
+    # Function run by a worker process: builds the index of one shard of documents.
+    partial_dic = defaultdict(lambda: array('I'))
+    partial_positions = {}
+    partial_words = {}
+    for doc_id, f_path in shard:
+        words = tokenizeDocument(os.path.join(directory, f_path))
+        for word in words:
+            partial_dic[word].append(doc_id)
+        partial_positions[doc_id] = encodePositions(words)
+        partial_words[doc_id] = list(words)
+    return dict(partial_dic), partial_positions, partial_words
+
+def indexDocument(doc_id, f_path, positions_file):
+    # Function to read a single document and add its words to the index.
+    words = tokenizeDocument(os.path.join(path, f_path))
+    for word in words:
+        # Indexing: Storing each word along with the document it appeared in.
+        addPostings(word, (doc_id,))
+    # Interning shares one string per word between dic and doc_words.
+    doc_words[doc_id] = tuple(sys.intern(word) for word in words)
+    writePositions(doc_id, encodePositions(words), positions_file)
+
+def addPostings(word, new_ids):
+    # Function to append document IDs, larger than all existing ones, to a word's postings.
+    postings = dic.get(word)
+    if postings is None:
+        dic[sys.intern(word)] = array('I', new_ids)
+    else:
+        postings.extend(new_ids)
+
+def encodePositions(words):
+    # Function to lay out the positions of every word of a document as stored in the
+    # positions store: where each word's positions start and where the last ones end,
+    # then all the positions.
+    bounds = array('I', accumulate((len(found) for found in words.values()), initial=0))
+    return bounds.tobytes() + b''.join(found.tobytes() for found in words.values())
+
+def writePositions(doc_id, entry, positions_file):
+    # Function to append the positions of a document to the positions store.
+    offset = positions_file.tell()
+    positions_file.write(entry)
+    position_offsets[doc_id] = (offset, len(entry))
+
+def tokenizeDocument(file_path):
+    # Function to read a document and return the positions of every word it contains,
+    # ignoring short words. Positions count all words, so phrases can skip short ones.
+    # Words are returned in sorted order, the order in which their positions are stored.
+    words = {}
+    for position, word in enumerate(readWords(file_path)):
+        if len(word) > 3:
+            found = words.get(word)
+            if found is None:
+                words[word] = found = array('I')
+            found.append(position)
+    return dict(sorted(words.items()))
+
+def readWords(file_path):
+    # Generator that yields the lowercase words of a document one chunk at a time. A word
+    # cut off at the end of a chunk is carried over and joined to the start of the next one.
+    carry = ''
+    with open(file_path, 'r') as file:
+        while True:
+            chunk = file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            # Clean the chunk to remove punctuation using regular expressions.
+            cleaned_chunk = carry + re.sub(r'[^\w\s]', '', chunk)
+            words = cleaned_chunk.split()
+            carry = ''
+            if words and not cleaned_chunk[-1].isspace():
+                carry = words.pop()  # The word may continue in the next chunk.
             for word in words:
-                # Indexing: Storing each word along with the document it appeared in.
-                dic[word].add(f_path)
+                yield word.lower()
+    if carry:
+        yield carry.lower()
+
+def removeDocument(f_path):
+    # Function to remove every posting of a document from the index.
+    doc_id = doc_ids.pop(f_path)
+    doc_names[doc_id] = None  # IDs are never reused, gaps are dropped by compactIndex().
+    for word in doc_words.pop(doc_id, ()):
+        postings = dic.get(word)
+        if postings is not None:
+            i = bisect_left(postings, doc_id)
+            if i < len(postings) and postings[i] == doc_id:
+                del postings[i]
+            if not postings:
+                del dic[word]  # No document contains the word anymore.
+    del indexed_files[f_path]
+    del doc_offsets[f_path]
+    del position_offsets[doc_id]  # Its bytes are dropped by compactIndex().
+
+def scanDocuments():
+    # Records the modification time and size of every document so changes can be detected.
+    files = {}
+    for entry in os.scandir(path):
+        stat = entry.stat()
+        files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+def loadIndex():
+    # Loads the saved index with a single read. Documents changed since it was saved are
+    # picked up afterwards by an incremental readAllDocument().
+    global dic, doc_names, doc_ids, doc_words, indexed_files, doc_offsets, position_offsets
+    try:
+        with open(index_path, 'rb') as file:
+            saved = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return False
+    if saved.get('version') != INDEX_VERSION:
+        return False  # Saved by an older version, rebuild from scratch.
+    try:
+        if (os.path.getsize(pack_path) < saved['pack_size']
+                or os.path.getsize(positions_path) < saved['positions_size']):
+            return False  # The stores don't match the index anymore.
+    except OSError:
+        return False
+    # Positions stay in the positions store until a phrase query reads them.
+    dic = {word: decodePostings(gaps) for word, gaps in saved['index'].items()}
+    doc_names = saved['doc_names']
+    doc_ids = {f_path: doc_id for doc_id, f_path in enumerate(doc_names) if f_path is not None}
+    doc_words = saved['doc_words']
+    indexed_files = saved['files']
+    doc_offsets = saved['doc_offsets']
+    position_offsets = saved['position_offsets']
+    return True
+
+def saveIndex():
+    # Writes the vocabulary, postings and file stats to disk. The temporary file keeps a
+    # crash during writing from leaving a half-written index behind.
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as file:
+        index = {word: encodePostings(postings) for word, postings in dic.items()}
+        pack_size = max((offset + length for offset, length in doc_offsets.values()), default=0)
+        positions_size = max((offset + length for offset, length in position_offsets.values()), default=0)
+        saved = {'version': INDEX_VERSION, 'files': indexed_files, 'index': index,
+                 'doc_names': doc_names, 'doc_words': doc_words,
+                 'doc_offsets': doc_offsets, 'pack_size': pack_size,
+                 'position_offsets': position_offsets, 'positions_size': positions_size}
+        pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+
+def encodePostings(postings):
+    # Stores a postings list as the gaps between consecutive values, using the
+    # narrowest array type that fits them. Gaps are small, so most lists need 1 byte per value.
+    gaps = array('I', postings)
+    for i in range(len(gaps) - 1, 0, -1):
+        gaps[i] -= gaps[i - 1]
+    for typecode in 'BH':
+        if max(gaps) < 1 << (8 * array(typecode).itemsize):
+            return array(typecode, gaps)
+    return gaps
+
+def decodePostings(gaps):
+    # Turns saved gaps back into a sorted array of document IDs.
+    return array('I', accumulate(gaps))
 
 if __name__ == '__main__':
     main()  
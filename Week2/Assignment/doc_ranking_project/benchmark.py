@@ -0,0 +1,186 @@
+"""
+Benchmark of the ranking code on synthetic corpora.
+
+Generates corpora whose words follow a Zipf distribution, then measures the index
+build time and memory peak, the query latency of every search mode and the time
+spent highlighting results. Results are written as JSON so that two runs (e.g.
+before and after a change) can be compared:
+
+    python benchmark.py --sizes 1000,10000,100000 --output after.json --baseline before.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from ranking.utils import TfidfIndex, search_documents_tfidf
+
+
+def generate_corpus(size, vocabulary, zipf, doc_length, rng):
+    # Word ranks are drawn with probability proportional to 1 / rank ** zipf
+    weights = 1.0 / np.arange(1, vocabulary + 1) ** zipf
+    weights /= weights.sum()
+    lengths = np.maximum(1, rng.poisson(doc_length, size))
+    ranks = rng.choice(vocabulary, size=int(lengths.sum()), p=weights)
+    documents = []
+    start = 0
+    for idx, length in enumerate(lengths):
+        words = ' '.join(f'w{rank}' for rank in ranks[start:start + length])
+        documents.append({'title': f'doc{idx}.txt', 'content': words})
+        start += length
+    return documents, weights
+
+
+def generate_queries(count, terms, vocabulary, weights, rng):
+    # Query words follow the corpus distribution, so common words show up in queries too
+    queries = []
+    for _ in range(count):
+        length = rng.integers(terms[0], terms[1] + 1)
+        queries.append(' '.join(f'w{rank}' for rank in rng.choice(vocabulary, size=length, p=weights)))
+    return queries
+
+
+def latency_stats(seconds):
+    milliseconds = np.array(seconds) * 1000
+    return {
+        'mean': float(milliseconds.mean()),
+        'p50': float(np.percentile(milliseconds, 50)),
+        'p95': float(np.percentile(milliseconds, 95)),
+        'p99': float(np.percentile(milliseconds, 99)),
+    }
+
+
+def time_queries(search, queries):
+    seconds = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query)
+        seconds.append(time.perf_counter() - start)
+    return latency_stats(seconds)
+
+
+def run(size, args, rng):
+    documents, weights = generate_corpus(size, args.vocabulary, args.zipf, args.doc_length, rng)
+    queries = generate_queries(args.queries, args.query_terms, args.vocabulary, weights, rng)
+
+    # tracemalloc slows down every allocation, so the build is timed without it and
+    # built a second time to measure its memory peak
+    start = time.perf_counter()
+    index = TfidfIndex(documents)
+    build_seconds = time.perf_counter() - start
+    tracemalloc.start()
+    TfidfIndex(documents)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    modes = {
+        'tfidf_all': lambda query: index.search(query),
+        'tfidf_top_k': lambda query: index.search(query, top_k=args.top_k, pruning=False),
+        'tfidf_top_k_maxscore': lambda query: index.search(query, top_k=args.top_k),
+        'bm25_top_k_maxscore': lambda query: index.search(query, top_k=args.top_k, ranking='bm25'),
+    }
+    latency = {name: time_queries(search, queries) for name, search in modes.items()}
+    if size <= args.legacy_max_documents:
+        # Rebuilds the whole index for every query, so only a few queries on small corpora
+        legacy_queries = queries[:args.legacy_queries]
+        latency['search_documents_tfidf'] = time_queries(
+            lambda query: search_documents_tfidf(query, documents), legacy_queries)
+
+    highlight_seconds = []
+    for query in queries:
+        results = index.search(query, top_k=args.top_k)
+        start = time.perf_counter()
+        for result in results:
+            result.content
+        highlight_seconds.append(time.perf_counter() - start)
+
+    return {
+        'documents': size,
+        'build_seconds': build_seconds,
+        'build_peak_memory_mb': peak_memory / 2 ** 20,
+        'vocabulary_indexed': len(index.vocabulary),
+        'latency_ms': latency,
+        'highlight_top_k_ms': latency_stats(highlight_seconds),
+    }
+
+
+def compare(results, baseline, max_regression):
+    # Prints the change of every p50/p95 latency and the build time against the baseline,
+    # and returns the number of them that got slower than allowed
+    previous = {run['documents']: run for run in baseline['results']}
+    regressions = 0
+    for current in results:
+        before = previous.get(current['documents'])
+        if before is None:
+            continue
+        pairs = [('build_seconds', before['build_seconds'], current['build_seconds'])]
+        for mode, stats in current['latency_ms'].items():
+            if mode in before['latency_ms']:
+                for percentile in ('p50', 'p95'):
+                    pairs.append((f'{mode} {percentile}', before['latency_ms'][mode][percentile], stats[percentile]))
+        for name, old, new in pairs:
+            ratio = new / old if old else float('inf')
+            slower = ratio > max_regression
+            regressions += slower
+            print(f"  {current['documents']:>9} docs  {name:<32} {old:10.3f} -> {new:10.3f}  x{ratio:.2f}{'  REGRESSION' if slower else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the TF-IDF ranker on synthetic corpora.")
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help="comma-separated corpus sizes in documents (default: 1000,10000,100000)")
+    parser.add_argument('--vocabulary', type=int, default=50000, help="number of distinct words (default: 50000)")
+    parser.add_argument('--zipf', type=float, default=1.1, help="Zipf exponent of word frequencies (default: 1.1)")
+    parser.add_argument('--doc-length', type=int, default=100, help="average words per document (default: 100)")
+    parser.add_argument('--queries', type=int, default=200, help="queries timed per corpus (default: 200)")
+    parser.add_argument('--query-terms', default='1,3', help="min,max words per query (default: 1,3)")
+    parser.add_argument('--top-k', type=int, default=10, help="results kept by the top-k modes (default: 10)")
+    parser.add_argument('--legacy-max-documents', type=int, default=10000,
+                        help="largest corpus on which search_documents_tfidf is timed (default: 10000)")
+    parser.add_argument('--legacy-queries', type=int, default=5,
+                        help="queries timed with search_documents_tfidf (default: 5)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--max-regression', type=float, default=1.2,
+                        help="slowdown ratio against the baseline reported as a regression (default: 1.2)")
+    args = parser.parse_args()
+    args.query_terms = tuple(int(value) for value in args.query_terms.split(','))
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size in (int(value) for value in args.sizes.split(',')):
+        result = run(size, args, rng)
+        results.append(result)
+        latency = result['latency_ms']
+        print(f"{size:>9} docs  build {result['build_seconds']:.2f} s, peak {result['build_peak_memory_mb']:.1f} MB")
+        for mode, stats in latency.items():
+            print(f"           {mode:<24} p50 {stats['p50']:8.3f}  p95 {stats['p95']:8.3f}  p99 {stats['p99']:8.3f} ms")
+        stats = result['highlight_top_k_ms']
+        print(f"           {'highlight_top_k':<24} p50 {stats['p50']:8.3f}  p95 {stats['p95']:8.3f}  p99 {stats['p99']:8.3f} ms")
+
+    report = {
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        print(f"Compared with {args.baseline}:")
+        if compare(results, baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -123,3 +123,9 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Search results cache of the ranking app: None keeps the last
+# RANKING_RESULT_CACHE_SIZE queries in each process, or name one of CACHES
+# (e.g. 'default') to store them in a shared Django cache instead.
+RANKING_RESULT_CACHE = None
+RANKING_RESULT_CACHE_SIZE = 1024
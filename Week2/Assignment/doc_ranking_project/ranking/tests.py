@@ -1,3 +1,354 @@
-from django.test import TestCase
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from .utils import (
+    RANKINGS, DjangoResultCache, DocumentSource, ResultCache, SpellingCorrector, TfidfIndex, compile_terms,
+    create_result_cache, edit_distance, highlight_snippet,
+)
+
+# Few distinct words, so many documents get the same score
+DOCUMENTS = [{'title': f'doc{idx}.txt', 'content': content} for idx, content in enumerate([
+    'apple banana', 'apple banana', 'banana cherry', 'apple', 'cherry cherry apple',
+    'banana apple', 'date', 'apple banana', 'cherry', 'banana', 'apple cherry', 'apple',
+    'banana banana apple', 'cherry apple', 'apple banana', 'date apple',
+])]
+
+
+class SearchApiTests(SimpleTestCase):
+    def setUp(self):
+        self.index = TfidfIndex(DOCUMENTS)
+        patcher = mock.patch('ranking.views.get_tfidf_index', return_value=self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_all_pages(self, query, limit, ranking='tfidf'):
+        hits = []
+        offset = 0
+        while True:
+            response = self.client.get('/api/search/', {'query': query, 'offset': offset,
+                                                        'limit': limit, 'ranking': ranking})
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            hits.extend(page['results'])
+            if not page['has_more']:
+                return hits
+            offset += limit
+
+    def test_pages_cover_every_hit_once(self):
+        for query in ('apple', 'banana', 'apple banana', 'cherry apple date'):
+            for ranking in ('tfidf', 'bm25'):
+                expected = [result.title for result in self.index.search(query, ranking=ranking)]
+                for limit in (1, 2, 3, 5, 100):
+                    with self.subTest(query=query, ranking=ranking, limit=limit):
+                        hits = self.get_all_pages(query, limit, ranking)
+                        self.assertEqual([hit['id'] for hit in hits], expected)
+
+    def test_hit_ids_are_file_names(self):
+        hits = self.get_all_pages('date', 10)
+        self.assertEqual(sorted(hit['id'] for hit in hits), ['doc15.txt', 'doc6.txt'])
+
+    def test_invalid_limit(self):
+        response = self.client.get('/api/search/', {'query': 'apple', 'limit': 0})
+        self.assertEqual(response.status_code, 400)
+
+
+class TopKTests(SimpleTestCase):
+    def random_index(self, rng):
+        # A handful of words over many short documents gives plenty of tied scores
+        words = [f'w{idx}' for idx in range(rng.randint(3, 12))]
+        documents = [{'title': f'doc{idx}.txt',
+                      'content': ' '.join(rng.choice(words) for _ in range(rng.randint(1, 6)))}
+                     for idx in range(rng.randint(5, 40))]
+        return TfidfIndex(documents), words
+
+    def test_top_k_matches_exhaustive_ranking(self):
+        rng = random.Random(0)
+        for _ in range(100):
+            index, words = self.random_index(rng)
+            query = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 7)))
+            for ranking in RANKINGS:
+                expected = [(result.doc_id, result.score) for result in index.search(query, ranking=ranking)]
+                for k in (1, 2, 3, 5, 8):
+                    for pruning in (True, False):
+                        with self.subTest(query=query, ranking=ranking, k=k, pruning=pruning):
+                            results = index.search(query, top_k=k, pruning=pruning, ranking=ranking)
+                            self.assertEqual([(result.doc_id, result.score) for result in results], expected[:k])
+
+    def test_score_top_k_keeps_exact_scores(self):
+        rng = random.Random(1)
+        for _ in range(100):
+            index, words = self.random_index(rng)
+            query_terms = [rng.choice(words) for _ in range(rng.randint(1, 7))]
+            for ranking in RANKINGS:
+                doc_ids, scores = index.score(query_terms, ranking)
+                exhaustive = dict(zip(doc_ids.tolist(), scores.tolist()))
+                doc_ids, scores = index.score_top_k(query_terms, 3, ranking)
+                with self.subTest(query=query_terms, ranking=ranking):
+                    for doc_id, score in zip(doc_ids.tolist(), scores.tolist()):
+                        self.assertEqual(score, exhaustive.get(doc_id, 0.0))
+
+
+class SpellingCorrectorTests(SimpleTestCase):
+    def test_matches_brute_force(self):
+        rng = random.Random(2)
+        terms = {''.join(rng.choice('abcde') for _ in range(rng.randint(2, 7))): rng.randint(1, 5)
+                 for _ in range(200)}
+        corrector = SpellingCorrector(terms)
+        for _ in range(300):
+            word = ''.join(rng.choice('abcdef') for _ in range(rng.randint(1, 8)))
+            candidates = [(edit_distance(word, term), -count, term) for term, count in terms.items()]
+            best = min(candidates)
+            expected = best[2] if best[0] <= corrector.max_distance else word
+            self.assertEqual(corrector.correction(word), expected)
+
+
+class HighlightSnippetTests(SimpleTestCase):
+    words = [f'w{idx}' for idx in range(100)]
+
+    def window(self, snippet):
+        return snippet.removeprefix('... ').removesuffix(' ...').split()
+
+    def test_window_around_first_match(self):
+        snippet = highlight_snippet(self.words, compile_terms(['w40']), length=20, context=5)
+        # 5 words before the match, 20 in all
+        window = ' '.join(self.words[35:55]).replace('w40', '<span class="highlight">w40</span>')
+        self.assertEqual(snippet, f'... {window} ...')
+
+    def test_no_markers_at_the_edges(self):
+        snippet = highlight_snippet(self.words, compile_terms(['w2']), length=20, context=5)
+        self.assertEqual(self.window(snippet)[0], 'w0')
+        self.assertFalse(snippet.startswith('...'))
+        snippet = highlight_snippet(self.words, compile_terms(['w98']), length=20, context=5)
+        # The window is moved back so it still holds `length` words
+        self.assertEqual(self.window(snippet)[0], 'w80')
+        self.assertFalse(snippet.endswith('...'))
+        self.assertTrue(snippet.startswith('... '))
+
+    def test_without_match_or_terms(self):
+        for pattern in (compile_terms(['missing']), compile_terms([])):
+            snippet = highlight_snippet(self.words, pattern, length=20, context=5)
+            self.assertEqual(snippet, ' '.join(self.words[:20]) + ' ...')
+        self.assertEqual(highlight_snippet(['short', 'text'], None), 'short text')
+
+    def test_terms_highlighted_in_one_pass(self):
+        words = 'The cat and the Cats sat in a category of cat food'.split()
+        snippet = highlight_snippet(words, compile_terms(['cat', 'cats']))
+        # Whole words only, whatever the case, and never a highlight inside another one
+        self.assertEqual(snippet, 'The <span class="highlight">cat</span> and the <span class="highlight">Cats</span> '
+                                  'sat in a category of <span class="highlight">cat</span> food')
+
+    def test_snippet_built_on_first_read(self):
+        index = TfidfIndex(DOCUMENTS)
+        with mock.patch('ranking.utils.highlight_snippet', return_value='snippet') as highlight:
+            results = index.search('cherry')
+            self.assertFalse(highlight.called)
+            self.assertEqual(results[0].content, 'snippet')
+            self.assertEqual(results[0]['content'], 'snippet')
+            highlight.assert_called_once_with(results[0].words, results[0].pattern)
+
+
+class DocumentDirectoryTestCase(SimpleTestCase):
+    result_cache = None
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.write('a.txt', 'apple banana', 1)
+        self.write('b.txt', 'banana cherry', 1)
+        # Polls far apart, so only the refreshes called by the tests happen
+        self.source = DocumentSource(self.directory, refresh_interval=3600, result_cache=self.result_cache)
+
+    def write(self, name, content, mtime):
+        file_path = os.path.join(self.directory, name)
+        with open(file_path, 'w') as file:
+            file.write(content)
+        os.utime(file_path, (mtime, mtime))
+
+
+class DocumentSourceTests(DocumentDirectoryTestCase):
+
+    def titles(self, index):
+        return sorted(doc['title'] for doc in index.documents)
+
+    def test_requests_reuse_the_loaded_index(self):
+        index = self.source.get_index()
+        self.assertEqual(self.titles(index), ['a.txt', 'b.txt'])
+        with mock.patch.object(self.source, 'refresh') as refresh:
+            self.assertIs(self.source.get_index(), index)
+        self.assertFalse(refresh.called)
+        self.assertFalse(self.source.refresh())
+        self.assertIs(self.source.get_index(), index)
+
+    def test_refresh_reads_only_changed_files(self):
+        self.source.refresh()
+        self.write('b.txt', 'cherry date', 2)
+        self.write('c.txt', 'date', 1)
+        os.remove(os.path.join(self.directory, 'a.txt'))
+        with mock.patch('ranking.utils.open', create=True, side_effect=open) as opened:
+            self.assertTrue(self.source.refresh())
+        self.assertEqual(sorted(os.path.basename(call.args[0]) for call in opened.call_args_list), ['b.txt', 'c.txt'])
+        index = self.source.get_index()
+        self.assertEqual(self.titles(index), ['b.txt', 'c.txt'])
+        # BM25, since the TF-IDF weights of a term found in every document are not positive
+        self.assertEqual([result.title for result in index.search('date', ranking='bm25')], ['c.txt', 'b.txt'])
+
+    def test_new_index_is_swapped_in_when_built(self):
+        old_index = self.source.get_index()
+        generation = self.source.generation
+        seen_while_building = []
+
+        def build(*args, **kwargs):
+            seen_while_building.append(self.source.get_index())
+            return TfidfIndex(*args, **kwargs)
+
+        self.write('a.txt', 'date', 2)
+        with mock.patch('ranking.utils.TfidfIndex', side_effect=build):
+            self.source.refresh()
+        # Readers kept the complete old index until the new one was published
+        self.assertEqual(seen_while_building, [old_index])
+        self.assertEqual(old_index.search('date', ranking='bm25'), [])
+        self.assertEqual([result.title for result in self.source.get_index().search('date', ranking='bm25')], ['a.txt'])
+        self.assertEqual(self.source.generation, generation + 1)
+
+
+class Bm25Tests(SimpleTestCase):
+    def test_scores_match_the_formula(self):
+        # N = 3 documents of 3, 2 and 1 words, so the average length is 2
+        index = TfidfIndex([{'title': 'a.txt', 'content': 'apple apple banana'},
+                            {'title': 'b.txt', 'content': 'banana cherry'},
+                            {'title': 'c.txt', 'content': 'cherry'}])
+        apple_idf = math.log(1 + (3 - 1 + 0.5) / (1 + 0.5))
+        banana_idf = math.log(1 + (3 - 2 + 0.5) / (2 + 0.5))
+        # k1 * (1 - b + b * length / average length), with k1 = 1.5 and b = 0.75
+        norm_a = 1.5 * (1 - 0.75 + 0.75 * 3 / 2)
+        norm_b = 1.5 * (1 - 0.75 + 0.75 * 2 / 2)
+        expected = {
+            'a.txt': apple_idf * 2 * 2.5 / (2 + norm_a) + banana_idf * 1 * 2.5 / (1 + norm_a),
+            'b.txt': banana_idf * 1 * 2.5 / (1 + norm_b),
+        }
+        for top_k in (None, 1):
+            with self.subTest(top_k=top_k):
+                results = index.search('apple banana', ranking='bm25', top_k=top_k)
+                self.assertEqual([result.title for result in results], ['a.txt', 'b.txt'][:top_k])
+                for result in results:
+                    self.assertAlmostEqual(result.score, expected[result.title])
+
+    def test_repeated_query_terms_count_again(self):
+        index = TfidfIndex(DOCUMENTS)
+        once = {result.doc_id: result.score for result in index.search('date', ranking='bm25')}
+        twice = {result.doc_id: result.score for result in index.search('date date', ranking='bm25')}
+        self.assertEqual(once.keys(), twice.keys())
+        for doc_id, score in once.items():
+            self.assertAlmostEqual(twice[doc_id], 2 * score)
+
+    def test_common_terms_keep_a_positive_idf(self):
+        index = TfidfIndex([{'title': f'{idx}.txt', 'content': 'apple'} for idx in range(4)])
+        self.assertGreater(index.bm25_idf['apple'], 0)
+        self.assertEqual(len(index.search('apple', ranking='bm25')), 4)
+
+
+class ResultCacheTests(DocumentDirectoryTestCase):
+    def setUp(self):
+        self.result_cache = ResultCache(8)
+        super().setUp()
+
+    def test_repeated_query_is_served_from_cache(self):
+        index = self.source.get_index()
+        results = index.search('Banana', ranking='bm25')
+        with mock.patch.object(index, 'rank', return_value=([], [], [])) as rank:
+            # Same normalized terms and options
+            cached = index.search('banana', ranking='bm25')
+            self.assertFalse(rank.called)
+            index.search('banana', ranking='tfidf')
+            self.assertTrue(rank.called)
+        self.assertEqual([(result.title, result.score) for result in cached],
+                         [(result.title, result.score) for result in results])
+
+    def test_least_recently_used_query_is_evicted(self):
+        cache = ResultCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_new_index_invalidates_results(self):
+        index = self.source.get_index()
+        index.search('banana', ranking='bm25')
+        self.assertEqual(len(self.result_cache.entries), 1)
+        self.write('a.txt', 'cherry', 2)
+        self.source.refresh()
+        self.assertEqual(len(self.result_cache.entries), 0)
+        new_index = self.source.get_index()
+        self.assertNotEqual(new_index.version, index.version)
+        self.assertEqual([result.title for result in new_index.search('banana', ranking='bm25')], ['b.txt'])
+
+    @override_settings(RANKING_RESULT_CACHE='results',
+                       CACHES={'results': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_django_cache_backend(self):
+        cache = create_result_cache()
+        self.assertIsInstance(cache, DjangoResultCache)
+        index = TfidfIndex(DOCUMENTS, version='v1', result_cache=cache)
+        index.search('cherry')
+        with mock.patch.object(index, 'rank') as rank:
+            index.search('cherry')
+        self.assertFalse(rank.called)
+
+
+class SearchLimitsTests(SimpleTestCase):
+    def setUp(self):
+        self.slots = threading.BoundedSemaphore(1)
+        for patcher in (mock.patch('ranking.views.search_slots', self.slots),
+                        mock.patch('ranking.views.get_tfidf_index', return_value=TfidfIndex(DOCUMENTS))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def wait_for_free_slot(self):
+        for _ in range(500):
+            if self.slots.acquire(blocking=False):
+                self.slots.release()
+                return
+            time.sleep(0.01)
+        self.fail("the search slot was never released")
+
+    def test_busy_when_max_pending_reached(self):
+        self.slots.acquire()
+        try:
+            self.assertEqual(self.client.get('/api/search/', {'query': 'apple'}).status_code, 503)
+            self.assertEqual(self.client.get('/', {'query': 'apple'}).status_code, 503)
+        finally:
+            self.slots.release()
+        self.assertEqual(self.client.get('/api/search/', {'query': 'apple'}).status_code, 200)
+
+    def test_timeout(self):
+        finish = threading.Event()
+        self.addCleanup(finish.set)
+
+        def slow_search(*args):
+            finish.wait(10)
+            return [], False
+
+        with mock.patch('ranking.views.SEARCH_TIMEOUT', 0.05), mock.patch('ranking.views.search_hits', slow_search):
+            self.assertEqual(self.client.get('/api/search/', {'query': 'apple'}).status_code, 504)
+            # The slot is held until the search really ends, even after the request gave up
+            self.assertEqual(self.client.get('/api/search/', {'query': 'apple'}).status_code, 503)
+            finish.set()
+            self.wait_for_free_slot()
+        self.assertEqual(self.client.get('/api/search/', {'query': 'apple'}).status_code, 200)
+
+    def test_home_timeout(self):
+        finish = threading.Event()
+        self.addCleanup(finish.set)
+        with mock.patch('ranking.views.SEARCH_TIMEOUT', 0.05), \
+                mock.patch('ranking.views.search_page', lambda *args: finish.wait(10)):
+            self.assertEqual(self.client.get('/', {'query': 'apple'}).status_code, 504)
+        finish.set()
+        self.wait_for_free_slot()
@@ -1,6 +1,7 @@
 from django.urls import path
-from .views import home
+from .views import home, search_api
 
 urlpatterns = [
     path('', home, name='home'),
+    path('api/search/', search_api, name='search_api'),
 ]
@@ -1,20 +1,39 @@
 import os
 from sklearn.feature_extraction.text import TfidfVectorizer
 import math
-from collections import Counter
+import numpy as np
+from scipy.sparse import csr_matrix
+from collections import Counter, OrderedDict, defaultdict
+from functools import cached_property, lru_cache
 from spellchecker import SpellChecker
 import string
 import re
+import threading
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+documents_dir = os.path.join(os.path.dirname(__file__), 'documents')
 
 def load_documents():
     documents = []
-    documents_dir = os.path.join(os.path.dirname(__file__), 'documents')
     for filename in os.listdir(documents_dir):
         if filename.endswith('.txt'):
             with open(os.path.join(documents_dir, filename), 'r') as file:
                 documents.append({'title': filename, 'content': file.read()})
     return documents
 
+def corpus_signature(directory=documents_dir):
+    # Name, modification time and size of every document, cheap to read without opening the files
+    signature = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.txt'):
+            stat = entry.stat()
+            signature.append((entry.name, stat.st_mtime_ns, stat.st_size))
+    return sorted(signature)
+
 def search_documents(query, documents):
     query_keywords = query.lower().split()
     ranked_documents = []
@@ -37,14 +56,33 @@ def compute_tf(document):
         tf[term] = tf[term] / total_terms
     return tf
 
+class IdfTable:
+    """
+    Document frequency and IDF of every term of a corpus, counted in a single pass:
+    each document is turned into a set once and adds 1 for each of its distinct terms.
+    """
+    def __init__(self, documents):
+        self.total_documents = len(documents)
+        self.document_frequency = Counter()
+        for doc in documents:
+            self.document_frequency.update(set(doc))
+        self.idf = {term: math.log(self.total_documents / (1 + containing_docs))
+                    for term, containing_docs in self.document_frequency.items()}
+
+    def get(self, term, default=0):
+        return self.idf.get(term, default)
+
+    def __getitem__(self, term):
+        return self.idf[term]
+
+    def __contains__(self, term):
+        return term in self.idf
+
+    def __len__(self):
+        return len(self.idf)
+
 def compute_idf(documents):
-    idf = {}
-    total_documents = len(documents)
-    all_terms = set(term for doc in documents for term in doc)
-    for term in all_terms:
-        containing_docs = sum(1 for doc in documents if term in doc)
-        idf[term] = math.log(total_documents / (1 + containing_docs))
-    return idf
+    return IdfTable(documents).idf
 
 def compute_tfidf(tf, idf):
     tfidf = {}
@@ -62,41 +100,485 @@ def cosine_similarity(doc_tfidf, query_tfidf):
 
 
 
-def search_documents_tfidf(query, documents, preprocess=False, ignore_spelling=False):
-    if preprocess:
-        query_terms = preprocess_text(query, ignore_spelling)
-    else:
-        query_terms = query.lower().split()
+BM25_K1 = 1.5  # Saturation of the term frequency
+BM25_B = 0.75  # How much scores are normalized by document length
+RANKINGS = ('tfidf', 'bm25')
+SCORE_TOLERANCE = 1e-9  # Rounding slack of the score bounds used for pruning
 
-    corpus = [doc['content'].lower().split() for doc in documents]
-    titles = [doc['title'] for doc in documents]
+class TfidfIndex:
+    """
+    TF-IDF and BM25 document weights of a corpus, computed once so that a query only
+    has to compute its own weights and the scores.
 
-    tf_corpus = [compute_tf(doc) for doc in corpus]
-    idf = compute_idf(corpus)
-    tfidf_corpus = [compute_tfidf(tf, idf) for tf in tf_corpus]
+    For TF-IDF the document vectors are divided by their norms up front, so the cosine
+    similarity needs no per-document norm. For BM25 the document lengths and their
+    average are folded into the weights. Both are kept in a TermMatrix, so scoring a
+    query with either ranking is a sparse dot product.
+    """
+    def __init__(self, documents, version='', result_cache=None):
+        self.documents = documents
+        self.version = version  # Identifies the corpus in result cache keys
+        self.result_cache = result_cache
+        self.titles = [doc['title'] for doc in documents]
+        self.corpus = [doc['content'].lower().split() for doc in documents]
+        self.idf_table = IdfTable(self.corpus)
+        self.idf = self.idf_table.idf
+        self.vocabulary = {term: column for column, term in enumerate(self.idf)}
+        self.doc_lengths = np.array([len(doc) for doc in self.corpus], dtype=float)
+        self.average_doc_length = self.doc_lengths.mean() if len(self.corpus) else 0.0
+        total_documents = self.idf_table.total_documents
+        # BM25 IDF stays positive even for terms found in most documents
+        self.bm25_idf = {term: math.log(1 + (total_documents - containing_docs + 0.5) / (containing_docs + 0.5))
+                         for term, containing_docs in self.idf_table.document_frequency.items()}
 
-    query_tf = compute_tf(query_terms)
-    query_tfidf = compute_tfidf(query_tf, idf)
+        tfidf_postings = ([], [], [])
+        bm25_postings = ([], [], [])
+        for idx, doc in enumerate(self.corpus):
+            doc_tfidf = compute_tfidf(compute_tf(doc), self.idf)
+            doc_norm = vector_norm(doc_tfidf)
+            if doc_norm != 0:
+                for term, value in doc_tfidf.items():
+                    if value != 0:
+                        add_posting(tfidf_postings, self.vocabulary[term], idx, value / doc_norm)
+            if not doc:
+                continue
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[idx] / self.average_doc_length)
+            for term, count in Counter(doc).items():
+                add_posting(bm25_postings, self.vocabulary[term], idx,
+                            self.bm25_idf[term] * count * (BM25_K1 + 1) / (count + length_norm))
+        shape = (len(self.vocabulary), len(self.corpus))
+        self.matrices = {'tfidf': TermMatrix(tfidf_postings, shape), 'bm25': TermMatrix(bm25_postings, shape)}
 
-    scores = [cosine_similarity(doc_tfidf, query_tfidf) for doc_tfidf in tfidf_corpus]
+    @cached_property
+    def speller(self):
+        # Only built when a query first asks for spelling correction
+        return SpellingCorrector(self.idf_table.document_frequency)
 
-    ranked_documents = []
-    for idx, score in enumerate(scores):
-        if score > 0:
-            highlighted_content = highlight_terms(' '.join(corpus[idx]), query_terms)
-            ranked_documents.append({'title': titles[idx], 'content': highlighted_content, 'score': score})
+    def query_weights(self, query_terms, ranking='tfidf'):
+        """Return the weight of every query term found in the index, by term row."""
+        if ranking == 'bm25':
+            # Each occurrence of a term in the query adds its document weight once more
+            return {self.vocabulary[term]: count for term, count in Counter(query_terms).items()
+                    if term in self.vocabulary}
+        query_tfidf = compute_tfidf(compute_tf(query_terms), self.idf)
+        query_norm = vector_norm(query_tfidf)
+        if query_norm == 0:
+            return {}
+        return {self.vocabulary[term]: value / query_norm
+                for term, value in query_tfidf.items() if value != 0}
 
-    ranked_documents.sort(key=lambda x: x['score'], reverse=True)
-    return ranked_documents
+    def score(self, query_terms, ranking='tfidf'):
+        """Return the IDs and scores of the documents sharing a term with the query."""
+        return self.matrices[ranking].score(self.query_weights(query_terms, ranking))
+
+    def score_top_k(self, query_terms, k, ranking='tfidf'):
+        """Return the IDs and scores of the documents that can still be among the k best."""
+        return self.matrices[ranking].score_top_k(self.query_weights(query_terms, ranking), k)
+
+    def search(self, query, preprocess=False, ignore_spelling=False, top_k=None, pruning=True, ranking='tfidf'):
+        if ranking not in RANKINGS:
+            raise ValueError(f"Unknown ranking {ranking!r}, expected one of {', '.join(RANKINGS)}")
+        cache_key = None
+        cached = None
+        if self.result_cache is not None:
+            normalized = preprocess_text(query) if preprocess else query.lower().split()
+            cache_key = result_cache_key(normalized, preprocess, ignore_spelling, ranking, top_k, self.version)
+            cached = self.result_cache.get(cache_key)
+        if cached is None:
+            cached = self.rank(query, preprocess, ignore_spelling, top_k, pruning, ranking)
+            if cache_key is not None:
+                self.result_cache.set(cache_key, cached)
+
+        query_terms, doc_ids, scores = cached
+        pattern = compile_terms(query_terms)
+        return [RankedDocument(idx, self.titles[idx], score, self.corpus[idx], pattern)
+                for idx, score in zip(doc_ids, scores)]
+
+    def rank(self, query, preprocess, ignore_spelling, top_k, pruning, ranking):
+        """Return the query terms and the IDs and scores of the matching documents, best first."""
+        if preprocess:
+            query_terms = preprocess_text(query, ignore_spelling, corrector=self.speller)
+        else:
+            query_terms = query.lower().split()
+
+        if top_k is not None and pruning:
+            doc_ids, scores = self.score_top_k(query_terms, top_k, ranking)
+        else:
+            doc_ids, scores = self.score(query_terms, ranking)
+        matches = scores > 0
+        doc_ids, scores = doc_ids[matches], scores[matches]
+        if top_k is not None and top_k < len(scores):
+            # Only the k best scores are needed, so partition instead of sorting all of them.
+            # Every document tied with the k-th score is kept, so the sort below can give
+            # the tie to the lowest IDs instead of whichever ones the partition picked.
+            kth_score = -np.partition(-scores, top_k - 1)[top_k - 1]
+            best = scores >= kth_score
+            doc_ids, scores = doc_ids[best], scores[best]
+        order = np.lexsort((doc_ids, -scores))[:top_k]
+        # Plain lists, so the result can be stored in any cache backend
+        return query_terms, doc_ids[order].tolist(), scores[order].tolist()
+
+def add_posting(postings, term_id, doc_id, weight):
+    term_ids, doc_ids, weights = postings
+    term_ids.append(term_id)
+    doc_ids.append(doc_id)
+    weights.append(weight)
+
+class TermMatrix:
+    """
+    Document weights in a sparse matrix in CSR layout with one row per term (the
+    transpose of the document-term matrix). Scoring a query is a single sparse product
+    that only reads the rows of the query terms.
+    """
+    def __init__(self, postings, shape):
+        term_ids, doc_ids, weights = postings
+        self.matrix = csr_matrix((weights, (term_ids, doc_ids)), shape=shape)
+        self.matrix.sort_indices()
+
+        # Largest and smallest weight of every term, used for the score bounds of score_top_k
+        self.term_max = np.zeros(shape[0])
+        self.term_min = np.zeros(shape[0])
+        non_empty = np.diff(self.matrix.indptr) > 0
+        if non_empty.any():
+            starts = self.matrix.indptr[:-1][non_empty]
+            self.term_max[non_empty] = np.maximum.reduceat(self.matrix.data, starts)
+            self.term_min[non_empty] = np.minimum.reduceat(self.matrix.data, starts)
+
+    def score(self, query_weights):
+        """Return the IDs and scores of the documents having a row of the query."""
+        if not query_weights:
+            return np.empty(0, dtype=np.intp), np.empty(0)
+        columns = sorted(query_weights)
+        query_vector = csr_matrix(([query_weights[column] for column in columns], columns, [0, len(columns)]),
+                                  shape=(1, self.matrix.shape[0]))
+        scores = query_vector @ self.matrix
+        return scores.indices, scores.data
+
+    def score_top_k(self, query_weights, k):
+        """
+        Return the IDs and scores of the documents that can still be among the k best,
+        using MaxScore. Terms are processed from the largest upper bound to the
+        smallest. Once the terms left can't lift a new document above the k-th best score,
+        their postings are only looked up for the documents already collected, and
+        documents that can no longer reach the top k are dropped.
+        """
+        terms = []
+        for term_id, weight in query_weights.items():
+            start, end = self.matrix.indptr[term_id], self.matrix.indptr[term_id + 1]
+            # Weights can be negative, so a term can also lower the score of a document
+            high = weight * (self.term_max[term_id] if weight > 0 else self.term_min[term_id])
+            low = weight * (self.term_min[term_id] if weight > 0 else self.term_max[term_id])
+            terms.append((max(high, 0.0), min(low, 0.0), weight, start, end))
+        terms.sort(key=lambda term: term[0], reverse=True)
+
+        doc_ids = np.empty(0, dtype=self.matrix.indices.dtype)
+        scores = np.empty(0)
+        collecting = True
+        for idx, (high, low, weight, start, end) in enumerate(terms):
+            # Summed again rather than subtracted, so rounding can't push them below the scores
+            remaining_high = sum(term[0] for term in terms[idx + 1:])
+            remaining_low = sum(term[1] for term in terms[idx + 1:])
+            term_docs = self.matrix.indices[start:end]
+            term_scores = weight * self.matrix.data[start:end]
+            if collecting:
+                doc_ids, positions = np.unique(np.concatenate((doc_ids, term_docs)), return_inverse=True)
+                scores = np.bincount(positions, weights=np.concatenate((scores, term_scores)), minlength=len(doc_ids))
+            elif len(doc_ids):
+                # Binary search the postings for the collected documents only
+                found = np.minimum(np.searchsorted(term_docs, doc_ids), len(term_docs) - 1)
+                hits = term_docs[found] == doc_ids
+                scores[hits] += term_scores[found[hits]]
+
+            # The k-th best score is at least this high whatever the remaining terms add
+            threshold = 0.0
+            if len(scores) >= k:
+                threshold = max(threshold, np.partition(scores, len(scores) - k)[len(scores) - k] + remaining_low)
+            # Partial sums depend on the order of the terms, so documents within rounding
+            # distance of the threshold are kept too and scored exactly below
+            threshold -= SCORE_TOLERANCE
+            # A document not collected yet scores at most remaining_high. Ties are kept,
+            # because the lower document ID wins them.
+            if collecting and (remaining_high <= 0 or remaining_high < threshold):
+                collecting = False
+            if not collecting:
+                keep = (scores + remaining_high > 0) & (scores + remaining_high >= threshold)
+                doc_ids, scores = doc_ids[keep], scores[keep]
+
+        # The scores of the documents left are summed again in term order, like score() does,
+        # so that documents with equal scores tie exactly as they do without pruning
+        scores = np.zeros(len(doc_ids))
+        for term_id in sorted(query_weights):
+            start, end = self.matrix.indptr[term_id], self.matrix.indptr[term_id + 1]
+            term_docs = self.matrix.indices[start:end]
+            if not len(term_docs) or not len(doc_ids):
+                continue
+            found = np.minimum(np.searchsorted(term_docs, doc_ids), len(term_docs) - 1)
+            hits = term_docs[found] == doc_ids
+            scores[hits] += query_weights[term_id] * self.matrix.data[start:end][found[hits]]
+        return doc_ids, scores
+
+class RankedDocument:
+    """
+    A search result. Its highlighted snippet is only built the first time `content` is
+    read, so results that are never rendered cost nothing. Supports result['title']
+    style access like the dictionaries returned before.
+    """
+    def __init__(self, doc_id, title, score, words, pattern):
+        self.doc_id = doc_id
+        self.title = title
+        self.score = score
+        self.words = words
+        self.pattern = pattern
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = highlight_snippet(self.words, self.pattern)
+        return self._content
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+def vector_norm(tfidf):
+    return math.sqrt(sum(value ** 2 for value in tfidf.values()))
+
+def result_cache_key(query_terms, preprocess, ignore_spelling, ranking, top_k, version):
+    # Hashed, so the key is valid for every cache backend whatever the query contains
+    key = repr((query_terms, preprocess, ignore_spelling, ranking, top_k, version))
+    return 'ranking:results:' + hashlib.sha1(key.encode()).hexdigest()
+
+class ResultCache:
+    """In-process LRU cache of search results holding at most `size` queries."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class DjangoResultCache:
+    """
+    Search results stored in one of Django's caches, e.g. to share them between
+    processes. Keys contain the corpus version, so entries of an older corpus are
+    never read again and simply expire.
+    """
+    def __init__(self, alias):
+        from django.core.cache import caches
+        self.cache = caches[alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+
+    def clear(self):
+        pass
+
+def create_result_cache():
+    from django.conf import settings
+    # RANKING_RESULT_CACHE names a Django cache to use instead of the in-process one
+    alias = getattr(settings, 'RANKING_RESULT_CACHE', None)
+    if alias:
+        return DjangoResultCache(alias)
+    return ResultCache(getattr(settings, 'RANKING_RESULT_CACHE_SIZE', 1024))
+
+REFRESH_INTERVAL = 5  # Seconds between two checks of the documents directory
+
+class DocumentSource:
+    """
+    The documents of a directory and their TF-IDF index, kept up to date by a background
+    thread that polls the modification times of the files. A refresh only reads the files
+    that changed and builds the new index aside; it is then published with a single
+    assignment, so requests never wait for it or touch the disk.
+    """
+    def __init__(self, directory=documents_dir, refresh_interval=REFRESH_INTERVAL, result_cache=None):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.result_cache = result_cache
+        self.signature = None
+        self.documents = {}  # (name, mtime, size) -> loaded document
+        self.index = None
+        self.generation = 0  # Incremented every time a new index is published
+        self.refresh_lock = threading.Lock()
+        self.thread = None
+
+    def get_index(self):
+        index = self.index
+        if index is None:
+            # Nothing has been loaded yet, the first request has to wait for it
+            self.refresh()
+            index = self.index
+        self.start()
+        return index
+
+    def refresh(self):
+        with self.refresh_lock:
+            signature = corpus_signature(self.directory)
+            if signature == self.signature:
+                return False
+            documents = {}
+            for key in signature:
+                document = self.documents.get(key)
+                if document is None:
+                    with open(os.path.join(self.directory, key[0]), 'r') as file:
+                        document = {'title': key[0], 'content': file.read()}
+                documents[key] = document
+            # The signature only depends on the files, so every process agrees on the version
+            version = hashlib.sha1(repr(signature).encode()).hexdigest()
+            index = TfidfIndex(list(documents.values()), version=version, result_cache=self.result_cache)
+            if self.result_cache is not None:
+                self.result_cache.clear()  # Results of the previous corpus can't be hit anymore
+            self.documents = documents
+            self.signature = signature
+            self.generation += 1
+            self.index = index
+            return True
+
+    def start(self):
+        if self.thread is None:
+            with self.refresh_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.watch, name='document-source', daemon=True)
+                    self.thread.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Refreshing the documents in %s failed", self.directory)
+
+# Documents and index shared by all requests of this process
+document_source = DocumentSource()
+
+def get_tfidf_index():
+    if document_source.result_cache is None:
+        document_source.result_cache = create_result_cache()
+    return document_source.get_index()
+
+def search_documents_tfidf(query, documents, preprocess=False, ignore_spelling=False):
+    return TfidfIndex(documents).search(query, preprocess=preprocess, ignore_spelling=ignore_spelling)
+
+SNIPPET_WORDS = 50  # Length of the snippet shown for a result
+SNIPPET_CONTEXT = 10  # Words kept before the first highlighted term
+
+def compile_terms(terms):
+    # One alternation for all terms, so highlighting is a single pass over the text.
+    # Word boundaries (\b) make it match whole words only
+    terms = sorted({term for term in terms if term}, key=len, reverse=True)
+    if not terms:
+        return None
+    return re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in terms) + r')\b', re.IGNORECASE)
 
 def highlight_terms(content, terms):
-    for term in terms:
-        # Use word boundaries (\b) to match whole words
-        content = re.sub(rf'\b{re.escape(term)}\b', f'<span class="highlight">{term}</span>', content, flags=re.IGNORECASE)
-    return content
+    pattern = compile_terms(terms)
+    if pattern is None:
+        return content
+    replacements = {term.lower(): term for term in terms if term}
+    return pattern.sub(lambda match: f'<span class="highlight">{replacements.get(match.group(0).lower(), match.group(0))}</span>', content)
+
+def highlight_snippet(words, pattern, length=SNIPPET_WORDS, context=SNIPPET_CONTEXT):
+    # Highlight a window of `length` words around the first word matching the pattern,
+    # instead of the whole document
+    first = 0
+    if pattern is not None:
+        first = next((idx for idx, word in enumerate(words) if pattern.search(word)), 0)
+    start = max(0, min(first - context, len(words) - length))
+    end = min(len(words), start + length)
+    snippet = ' '.join(words[start:end])
+    if pattern is not None:
+        snippet = pattern.sub(lambda match: f'<span class="highlight">{match.group(0)}</span>', snippet)
+    if start > 0:
+        snippet = '... ' + snippet
+    if end < len(words):
+        snippet = snippet + ' ...'
+    return snippet
+
+SPELLING_CACHE_SIZE = 10000  # Corrections remembered across requests
+MAX_EDIT_DISTANCE = 2
+
+class SpellingCorrector:
+    """
+    Spelling correction restricted to the terms of the corpus, using symmetric delete:
+    every term is indexed under all the strings obtained by deleting up to
+    MAX_EDIT_DISTANCE characters from it, so the candidates for a word are found by
+    looking up the deletes of the word instead of searching a whole dictionary.
+    Corrections are kept in a bounded LRU cache.
+    """
+    def __init__(self, term_counts, max_distance=MAX_EDIT_DISTANCE, cache_size=SPELLING_CACHE_SIZE):
+        self.max_distance = max_distance
+        punctuation = str.maketrans('', '', string.punctuation)
+        # Query words have their punctuation removed, so only such terms are useful corrections
+        self.term_counts = {term: count for term, count in term_counts.items() if term.translate(punctuation) == term}
+        self.deletes = defaultdict(list)
+        for term in self.term_counts:
+            for variant in deletes(term, max_distance):
+                self.deletes[variant].append(term)
+        self.correction = lru_cache(maxsize=cache_size)(self.find_correction)
+
+    def find_correction(self, word):
+        if word in self.term_counts:
+            return word
+        best = None
+        for variant in deletes(word, self.max_distance):
+            for term in self.deletes.get(variant, ()):
+                distance = edit_distance(word, term)
+                if distance > self.max_distance:
+                    continue
+                # Closest term first, then the most common one
+                key = (distance, -self.term_counts[term], term)
+                if best is None or key < best:
+                    best = key
+        # Words without a close term are kept, they simply match no document
+        return word if best is None else best[2]
+
+def deletes(word, max_distance):
+    # The word itself and every string obtained by deleting up to max_distance characters
+    variants = {word}
+    current = {word}
+    for _ in range(max_distance):
+        current = {variant[:idx] + variant[idx + 1:] for variant in current for idx in range(len(variant))}
+        variants |= current
+    return variants
+
+def edit_distance(source, target):
+    # Levenshtein distance where swapping two adjacent characters also counts as one edit
+    previous_previous = None
+    previous = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        current = [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if (i > 1 and j > 1 and source[i - 1] == target[j - 2] and source[i - 2] == target[j - 1]):
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        previous_previous, previous = previous, current
+    return previous[len(target)]
 
 spell = SpellChecker()
-def preprocess_text(text, ignore_spelling=False):
+# The general dictionary is only used without a corpus corrector; its corrections are cached too
+spell_correction = lru_cache(maxsize=SPELLING_CACHE_SIZE)(spell.correction)
+
+def preprocess_text(text, ignore_spelling=False, corrector=None):
     # Remove punctuation
     text = text.translate(str.maketrans('', '', string.punctuation))
     # Convert to lowercase
@@ -106,5 +588,6 @@ def preprocess_text(text, ignore_spelling=False):
 
     # Correct spelling if ignoring spelling mistakes
     if ignore_spelling:
-        words = [spell.correction(word) for word in words]
+        correction = corrector.correction if corrector is not None else spell_correction
+        words = [correction(word) for word in words]
     return words
\ No newline at end of file
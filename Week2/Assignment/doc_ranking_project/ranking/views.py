@@ -1,14 +1,119 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import render
-from .utils import load_documents, search_documents_tfidf
+from .utils import RANKINGS, get_tfidf_index
 
-def home(request):
-    documents = load_documents()
+API_DEFAULT_LIMIT = 10
+API_MAX_LIMIT = 100
+API_FIELDS = ('title', 'score', 'snippet', 'content')
+
+SEARCH_WORKERS = 4  # Threads loading documents and scoring queries
+SEARCH_MAX_PENDING = 32  # Searches running or queued before new ones are refused
+SEARCH_TIMEOUT = 10  # Seconds a request waits for its search
+
+# Searches run here, so a slow query never blocks the event loop serving the others
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix='search')
+search_slots = threading.BoundedSemaphore(SEARCH_MAX_PENDING)
+
+class SearchBusy(Exception):
+    pass
+
+async def run_search(function, *args):
+    """
+    Run a search in the search threads and wait for it for at most SEARCH_TIMEOUT seconds.
+    Raises SearchBusy when SEARCH_MAX_PENDING searches are already running or queued,
+    and asyncio.TimeoutError when the search takes too long.
+    """
+    if not search_slots.acquire(blocking=False):
+        raise SearchBusy()
+    future = search_executor.submit(function, *args)
+    # A thread can't be stopped, so the slot is only given back once the search is really over
+    future.add_done_callback(lambda future: search_slots.release())
+    return await asyncio.wait_for(asyncio.wrap_future(future), SEARCH_TIMEOUT)
+
+def search_page(query, preprocess, ignore_spelling, top_k, ranking):
+    results = get_tfidf_index().search(query, preprocess=preprocess, ignore_spelling=ignore_spelling, top_k=top_k, ranking=ranking)
+    for result in results:
+        result.content  # Highlight here rather than while rendering in the event loop
+    return results
+
+async def home(request):
     query = request.GET.get('query', '')
     preprocess = request.GET.get('preprocess', 'false').lower() == 'on'
     ignore_spelling = request.GET.get('ignore_spelling', 'false').lower() == 'on'
+    # Optional number of results to return, all matching documents when missing
+    k = request.GET.get('k', '')
+    top_k = int(k) if k.isdigit() and int(k) > 0 else None
+    ranking = request.GET.get('ranking', 'tfidf')
+    if ranking not in RANKINGS:
+        ranking = 'tfidf'
     results = []
 
     if query:
-        results = search_documents_tfidf(query, documents, preprocess=preprocess, ignore_spelling=ignore_spelling)
+        try:
+            results = await run_search(search_page, query, preprocess, ignore_spelling, top_k, ranking)
+        except SearchBusy:
+            return HttpResponse('Too many searches in progress, please try again.', status=503)
+        except asyncio.TimeoutError:
+            return HttpResponse('The search took too long, please try a shorter query.', status=504)
+
+    return render(request, 'ranking/home.html', {'query': query, 'results': results, 'preprocess': preprocess, 'ignore_spelling': ignore_spelling, 'ranking': ranking})
+
+def flag(request, name):
+    return request.GET.get(name, 'false').lower() in ('on', 'true', '1')
+
+def search_hits(query, preprocess, ignore_spelling, ranking, offset, limit, fields):
+    index = get_tfidf_index()
+    # One extra result tells whether there is a next page
+    results = index.search(query, preprocess=preprocess, ignore_spelling=ignore_spelling,
+                           top_k=offset + limit + 1, ranking=ranking)
+    hits = []
+    for result in results[offset:offset + limit]:
+        # The file name, since document positions change whenever the corpus is reloaded
+        hit = {'id': result.title}
+        for field in fields:
+            if field == 'snippet':
+                hit['snippet'] = result.content
+            elif field == 'content':
+                hit['content'] = index.documents[result.doc_id]['content']
+            else:
+                hit[field] = result[field]
+        hits.append(hit)
+    return hits, len(results) > offset + limit
+
+async def search_api(request):
+    """
+    JSON search: ?query=...&offset=0&limit=10&fields=title,score&ranking=tfidf
+    `fields` picks what each hit contains among title, score, snippet (highlighted)
+    and content (the whole document), so clients only pay for what they use.
+    """
+    query = request.GET.get('query', '')
+    try:
+        offset = int(request.GET.get('offset', 0))
+        limit = int(request.GET.get('limit', API_DEFAULT_LIMIT))
+    except ValueError:
+        return JsonResponse({'error': 'offset and limit must be integers'}, status=400)
+    if offset < 0 or not 0 < limit <= API_MAX_LIMIT:
+        return JsonResponse({'error': f'offset must be >= 0 and limit between 1 and {API_MAX_LIMIT}'}, status=400)
+    fields = [field for field in request.GET.get('fields', 'title,score').split(',') if field]
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown:
+        return JsonResponse({'error': f'unknown fields: {", ".join(unknown)}'}, status=400)
+    ranking = request.GET.get('ranking', 'tfidf')
+    if ranking not in RANKINGS:
+        return JsonResponse({'error': f'ranking must be one of {", ".join(RANKINGS)}'}, status=400)
+
+    hits = []
+    has_more = False
+    if query:
+        try:
+            hits, has_more = await run_search(search_hits, query, flag(request, 'preprocess'),
+                                              flag(request, 'ignore_spelling'), ranking, offset, limit, fields)
+        except SearchBusy:
+            return JsonResponse({'error': 'too many searches in progress'}, status=503)
+        except asyncio.TimeoutError:
+            return JsonResponse({'error': 'search timed out'}, status=504)
 
-    return render(request, 'ranking/home.html', {'query': query, 'results': results, 'preprocess': preprocess, 'ignore_spelling': ignore_spelling})
\ No newline at end of file
+    return JsonResponse({'query': query, 'offset': offset, 'limit': limit, 'has_more': has_more, 'results': hits})
@@ -122,3 +122,6 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Inverted index of the retrieval app, rebuilt from the Document table when missing.
+RETRIEVAL_INDEX_PATH = BASE_DIR / 'retrieval_index.pkl'
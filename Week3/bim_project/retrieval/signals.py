@@ -1,10 +1,18 @@
+from django.db import transaction
 from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from .models import Document
+from .utils import index_document, unindex_document
 
-is_graph_built = False  # Global flag to track graph status
+# The document graph reads its edges from the inverted index, so these keep both up to date
 
-@receiver([post_save, post_delete], sender=Document)
-def reset_graph_flag(sender, instance, **kwargs):
-    global is_graph_built
-    is_graph_built = False  # Reset the flag when documents change
+@receiver(post_save, sender=Document)
+def document_saved(sender, instance, **kwargs):
+    # Only once the transaction is committed, so a rollback never leaves the index ahead of the table
+    doc_id, content = instance.pk, instance.content
+    transaction.on_commit(lambda: index_document(doc_id, content))
+
+@receiver(post_delete, sender=Document)
+def document_deleted(sender, instance, **kwargs):
+    doc_id = instance.pk
+    transaction.on_commit(lambda: unindex_document(doc_id))
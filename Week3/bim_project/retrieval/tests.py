@@ -1,3 +1,178 @@
-from django.test import TestCase
+import io
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from .models import Document
+from .utils import (
+    Analyzer, IndexStore, InvertedIndex, document_graph, get_analyzer, get_inverted_index, preprocess_text,
+)
+
+
+class AnalyzerTests(SimpleTestCase):
+    def test_terms_are_stemmed_without_stop_words(self):
+        self.assertEqual(Analyzer().analyze('The dogs are Running, the cat runs.'), ['dog', 'run', 'cat', 'run'])
+
+    def test_stems_are_cached(self):
+        analyzer = Analyzer()
+        analyzer.analyze('running dogs running dogs running')
+        info = analyzer.stem.cache_info()
+        self.assertEqual((info.misses, info.hits), (2, 3))
+
+    def test_analyzer_is_shared(self):
+        self.assertIs(get_analyzer(), get_analyzer())
+
+    def test_nothing_is_printed(self):
+        with redirect_stdout(io.StringIO()) as output:
+            preprocess_text('Nothing should be printed while preprocessing')
+        self.assertEqual(output.getvalue(), '')
+
+
+class IndexTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.index_path = Path(directory.name) / 'retrieval_index.pkl'
+        settings_override = override_settings(RETRIEVAL_INDEX_PATH=self.index_path)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # A store of its own, so no index is shared with other tests
+        store_patch = mock.patch('retrieval.utils.index_store', IndexStore())
+        store_patch.start()
+        self.addCleanup(store_patch.stop)
+        self.first = Document.objects.create(title='first', content='Running dogs chase the cat')
+        self.second = Document.objects.create(title='second', content='A cat sleeps by the river')
+
+    def save(self, document):
+        # The index is only updated once the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            document.save()
+
+    def delete(self, document):
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
+
+    def assertMatchesTable(self, index=None):
+        documents = Document.objects.order_by('pk').values_list('pk', 'content')
+        expected = InvertedIndex.build(documents)
+        index = index or get_inverted_index()
+        self.assertEqual(index.postings, expected.postings)
+        self.assertEqual(index.doc_terms, expected.doc_terms)
+
+
+class IndexMaintenanceTests(IndexTestCase):
+    def test_save_edit_delete(self):
+        self.assertMatchesTable()
+        third = Document(title='third', content='The river runs to the sea')
+        self.save(third)
+        self.assertMatchesTable()
+        self.first.content = 'Music plays by the sea'
+        self.save(self.first)
+        self.assertMatchesTable()
+        self.delete(self.second)
+        self.assertMatchesTable()
+        self.assertEqual(get_inverted_index().get_postings('river'), [third.pk])
+
+    def test_changes_are_journaled_not_saved(self):
+        get_inverted_index()
+        snapshot_mtime = self.index_path.stat().st_mtime_ns
+        for idx in range(5):
+            self.save(Document(title=f'new{idx}', content='stone river'))
+        self.assertEqual(self.index_path.stat().st_mtime_ns, snapshot_mtime)
+        self.assertMatchesTable()
+        self.assertMatchesTable(IndexStore().get_index())
+
+    def test_other_process_sees_changes(self):
+        other = IndexStore()
+        other.get_index()
+        self.first.content = 'Stone walls'
+        self.save(self.first)
+        self.assertEqual(other.get_index().get_postings(preprocess_text('stone')[0]), [self.first.pk])
+
+    def test_table_is_checked_on_a_timer(self):
+        get_inverted_index()
+        Document.objects.bulk_create([Document(title='bulk', content='zebra')])
+        with self.assertNumQueries(0):
+            self.assertEqual(get_inverted_index().get_postings('zebra'), [])
+        with mock.patch('retrieval.utils.TABLE_CHECK_INTERVAL', 0):
+            self.assertMatchesTable()
+        self.assertEqual(len(get_inverted_index().get_postings('zebra')), 1)
+
+    def test_postings_are_changed_in_place(self):
+        postings = get_inverted_index().postings[preprocess_text('cat')[0]]
+        third = Document(title='third', content='Another cat')
+        self.save(third)
+        self.assertIs(get_inverted_index().postings['cat'], postings)
+        self.assertEqual(postings, [self.first.pk, self.second.pk, third.pk])
+        self.delete(self.first)
+        self.assertEqual(postings, [self.second.pk, third.pk])
+
+    def test_rotation_keeps_records_of_other_processes(self):
+        rotating, other = IndexStore(), IndexStore()
+        rotating.get_index()
+        other.get_index()
+        save = rotating.save
+        recorder = threading.Thread(target=other.record, args=(self.second.pk, {'stone': 1, 'bridg': 1}))
+
+        def slow_save():
+            # Another process records an edit while the snapshot is being written
+            Document.objects.filter(pk=self.second.pk).update(content='stone bridge')
+            recorder.start()
+            recorder.join(0.2)
+            save()
+
+        with mock.patch('retrieval.utils.JOURNAL_LIMIT', 1), mock.patch.object(rotating, 'save', slow_save):
+            rotating.record(self.first.pk, {'run': 1, 'dog': 1, 'chase': 1, 'cat': 1})
+        recorder.join()
+        for store in (rotating, other, IndexStore()):
+            self.assertEqual(store.get_index().get_postings('bridg'), [self.second.pk])
+
+
+class SearchTests(IndexTestCase):
+    def test_scores_from_postings(self):
+        self.save(Document(title='third', content='cat river'))
+        response = self.client.get('/retrieval/search/', {'query': 'cat river'})
+        results = response.context['results']
+        # |q ∩ d| / sqrt(|q| * |d|): third has only the two query terms
+        self.assertEqual([result['document'].title for result in results], ['third', 'second', 'first'])
+        self.assertAlmostEqual(results[0]['score'], 1.0)
+        self.assertAlmostEqual(results[1]['score'], 2 / (2 * 3) ** 0.5)
+        self.assertAlmostEqual(results[2]['score'], 1 / (2 * 4) ** 0.5)
+
+    def test_ties_go_to_lowest_id(self):
+        index = InvertedIndex.build([(1, 'cat dog'), (2, 'cat dog'), (3, 'cat dog')])
+        self.assertEqual([doc_id for doc_id, _ in index.search(['cat'], k=2)], [1, 2])
+
+
+class DocumentGraphTests(IndexTestCase):
+    def connected_titles(self, query):
+        return [document.title for document in document_graph.get_connected_documents(preprocess_text(query))]
+
+    def test_edges_follow_document_changes(self):
+        self.assertEqual(self.connected_titles('cat'), ['first', 'second'])
+        third = Document(title='third', content='A cat and a zebra')
+        self.save(third)
+        self.assertEqual(self.connected_titles('zebra river'), ['second', 'third'])
+        self.first.content = 'Zebras graze'
+        self.save(self.first)
+        self.assertEqual(self.connected_titles('cat'), ['second', 'third'])
+        self.assertEqual(self.connected_titles('zebra'), ['first', 'third'])
+        self.delete(third)
+        self.assertEqual(self.connected_titles('zebra cat'), ['first', 'second'])
+        self.assertEqual(document_graph.get_edges('zebra'), [self.first.pk])
+
+    def test_generation_changes_with_edges(self):
+        generation = document_graph.generation
+        self.assertEqual(document_graph.generation, generation)
+        self.save(Document(title='third', content='river stones'))
+        self.assertGreater(document_graph.generation, generation)
+
+    def test_changes_of_other_processes_are_seen(self):
+        self.assertEqual(self.connected_titles('zebra'), [])
+        other = IndexStore()
+        other.record(self.second.pk, {'zebra': 1})
+        self.assertEqual(self.connected_titles('zebra'), ['second'])
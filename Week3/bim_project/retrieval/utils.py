@@ -1,75 +1,413 @@
+import heapq
+import io
+import math
+import os
+import pickle
 import re
+import threading
+import time
+import uuid
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from django.conf import settings
+from django.db.models import Count, Max
 from nltk.corpus import stopwords
 from nltk.stem.porter import PorterStemmer
-from collections import defaultdict
 from .models import Document
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+STEM_CACHE_SIZE = 100000  # Distinct words whose stem is remembered
+
+class Analyzer:
+    """
+    Turns a text into its list of terms: lowercase words, without stop words, stemmed.
+    The stop words and the stemmer are loaded once, and the stems of the most
+    recent STEM_CACHE_SIZE distinct words are cached, since most words repeat
+    across documents.
+    """
+    token_pattern = re.compile(r'\b\w+\b')
+
+    def __init__(self, language='english', cache_size=STEM_CACHE_SIZE):
+        self.stop_words = frozenset(stopwords.words(language))
+        self.stemmer = PorterStemmer()
+        self.stem = lru_cache(maxsize=cache_size)(self.stemmer.stem)
+
+    def analyze(self, text):
+        return [self.stem(word) for word in self.token_pattern.findall(text.lower())
+                if word not in self.stop_words]
+
+analyzer = None
+analyzer_lock = threading.Lock()
+
+def get_analyzer():
+    # Created on first use, so importing the app doesn't need the NLTK data
+    global analyzer
+    if analyzer is None:
+        with analyzer_lock:
+            if analyzer is None:
+                analyzer = Analyzer()
+    return analyzer
+
 def preprocess_text(text):
-    # Tokenization
-    words = re.findall(r'\b\w+\b', text.lower())
-    # Remove stop words
-    stop_words = set(stopwords.words('english'))
-    words = [word for word in words if word not in stop_words]
-    print(words)
-    # Stemming
-    stemmer = PorterStemmer()
-    words = [stemmer.stem(word) for word in words]
-    return words
+    return get_analyzer().analyze(text)
+
+INDEX_VERSION = 2  # Bumped whenever the layout of the saved index changes
+
+class InvertedIndex:
+    """
+    Stemmed terms of the Document table: the sorted IDs of the documents containing
+    each term, and the term counts of every document. It is saved next to the database
+    and kept up to date by the post_save / post_delete signals of Document, so a search
+    only reads the postings of its own terms instead of re-tokenizing every document.
+    """
+    def __init__(self, postings=None, doc_terms=None):
+        self.postings = postings or {}  # term -> sorted list of document IDs
+        self.doc_terms = doc_terms or {}  # document ID -> {term: count}
+        self.last_id = max(self.doc_terms, default=None)
+        self.lock = threading.RLock()  # Held while postings are changed or read
+
+    @classmethod
+    def build(cls, documents):
+        """Index (id, content) pairs given in increasing ID order."""
+        postings = defaultdict(list)
+        doc_terms = {}
+        for doc_id, content in documents:
+            doc_terms[doc_id] = dict(Counter(preprocess_text(content)))
+            for term in doc_terms[doc_id]:
+                postings[term].append(doc_id)
+        return cls(dict(postings), doc_terms)
+
+    def add_document(self, doc_id, content):
+        """Index a new document, or re-index one whose content changed."""
+        self.set_terms(doc_id, dict(Counter(preprocess_text(content))))
+
+    def remove_document(self, doc_id):
+        self.set_terms(doc_id, None)
+
+    def set_terms(self, doc_id, counts):
+        """Replace the term counts of a document, None removing it from the index."""
+        with self.lock:
+            self.remove_terms(doc_id)
+            if counts is None:
+                if doc_id == self.last_id:
+                    self.last_id = max(self.doc_terms, default=None)
+                return
+            for term in counts:
+                insort(self.postings.setdefault(term, []), doc_id)
+            self.doc_terms[doc_id] = counts
+            self.last_id = doc_id if self.last_id is None else max(self.last_id, doc_id)
+
+    def remove_terms(self, doc_id):
+        counts = self.doc_terms.pop(doc_id, None)
+        for term in counts or ():
+            postings = self.postings[term]
+            del postings[bisect_left(postings, doc_id)]
+            if not postings:
+                del self.postings[term]
+
+    def state(self):
+        """Number of documents and highest ID, to compare with corpus_state()."""
+        return len(self.doc_terms), self.last_id
+
+    def get_postings(self, term):
+        # A copy, since the postings are changed in place
+        with self.lock:
+            return list(self.postings.get(term, ()))
+
+    def doc_length(self, doc_id):
+        """Number of distinct terms of a document, the squared norm of its binary vector."""
+        return len(self.doc_terms.get(doc_id, ()))
+
+    def union(self, terms):
+        """Sorted IDs of the documents containing any of the terms, merged from their postings."""
+        with self.lock:
+            merged = heapq.merge(*(self.postings.get(term, ()) for term in dict.fromkeys(terms)))
+            return [doc_id for doc_id, _ in groupby(merged)]
+
+    def search(self, query_terms, k=5):
+        """
+        The k documents most similar to the query as (doc ID, score) pairs, best first.
+        The score is the cosine of their binary vectors, |q ∩ d| / sqrt(|q| * |d|), where
+        |q ∩ d| is counted from the postings of the query terms, so documents without
+        any of them are never looked at. Ties go to the lowest ID.
+        """
+        # Query terms missing from the corpus are 0 in every vector and don't count in |q|
+        with self.lock:
+            query_terms = [term for term in dict.fromkeys(query_terms) if term in self.postings]
+            overlap = Counter()
+            for term in query_terms:
+                overlap.update(self.postings[term])
+            if not overlap:
+                return []
+            query_norm = math.sqrt(len(query_terms))
+            scores = ((doc_id, count / (query_norm * math.sqrt(self.doc_length(doc_id))))
+                      for doc_id, count in overlap.items() if self.doc_length(doc_id))
+            return heapq.nlargest(k, scores, key=lambda item: (item[1], -item[0]))
+
+def corpus_state():
+    # Number of documents and highest ID of the table. When they differ from the index,
+    # rows were added or deleted without signals (e.g. bulk_create or raw SQL).
+    state = Document.objects.aggregate(count=Count('pk'), last=Max('pk'))
+    return state['count'], state['last']
+
+def get_index_path():
+    return getattr(settings, 'RETRIEVAL_INDEX_PATH', settings.BASE_DIR / 'retrieval_index.pkl')
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def lock_file(file):
+    # Blocks until no other process holds the lock
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        return
+    file.seek(0)
+    while True:
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass  # LK_LOCK gives up after 10 seconds
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+JOURNAL_LIMIT = 1000  # Changes appended to the journal before the whole index is saved again
+TABLE_CHECK_INTERVAL = 60  # Seconds between two comparisons of the index with the table
+
+class IndexStore:
+    """
+    The inverted index of this process and the files it shares with the other processes
+    serving the app: a snapshot of the whole index, and a journal to which every saved or
+    deleted document appends one record. A change therefore costs one small append instead
+    of rewriting the index. Before the index is used, the records appended since it was
+    last used are replayed, whichever process wrote them. Every JOURNAL_LIMIT records, the
+    snapshot is saved again and a new empty journal is started. A lock file next to the
+    snapshot is held while the files are read or written, so no record can be appended
+    to a journal between its last replay and its removal.
+    """
+    def __init__(self):
+        self.index = None
+        self.path = None  # Snapshot the index was loaded from
+        self.snapshot_mtime = None
+        self.journal_path = None
+        self.journal_offset = 0  # Bytes of the journal already replayed
+        self.journal_records = 0
+        self.generation = 0  # Incremented whenever the index is loaded, rebuilt or changed
+        self.table_checked = None  # time.monotonic() of the last comparison with the table
+        self.lock = threading.RLock()
+        self.lock_file = None  # Open while this process holds the lock file
+        self.lock_depth = 0
+
+    @contextmanager
+    def locked(self):
+        """Hold the lock of this process's threads and the lock file shared with other processes."""
+        with self.lock:
+            if self.lock_depth == 0:
+                self.lock_file = open(f'{get_index_path()}.lock', 'a+b')
+                lock_file(self.lock_file)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    unlock_file(self.lock_file)
+                    self.lock_file.close()
+                    self.lock_file = None
+
+    def get_index(self):
+        """
+        The up to date index. It is compared with the table when it is loaded and then at most
+        every TABLE_CHECK_INTERVAL seconds, and built again from the table when they don't match.
+        """
+        with self.locked():
+            self.refresh()
+            now = time.monotonic()
+            if self.table_checked is None or now - self.table_checked >= TABLE_CHECK_INTERVAL:
+                if self.index.state() != corpus_state():
+                    self.build()
+                self.table_checked = now
+            return self.index
+
+    def refresh(self):
+        path = str(get_index_path())
+        if self.index is None or path != self.path or file_mtime(path) != self.snapshot_mtime:
+            self.load(path)
+        else:
+            self.replay()
+
+    def load(self, path):
+        self.path = path
+        # Read before opening, so a snapshot replaced meanwhile is noticed on the next call
+        mtime = file_mtime(path)
+        try:
+            with open(path, 'rb') as file:
+                saved = pickle.load(file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            saved = None
+        if not isinstance(saved, dict) or saved.get('version') != INDEX_VERSION:
+            self.build()
+            return
+        self.index = InvertedIndex(saved['postings'], saved['doc_terms'])
+        self.generation += 1
+        self.table_checked = None
+        self.snapshot_mtime = mtime
+        self.journal_path = f"{path}.{saved['journal']}.journal"
+        self.journal_offset = 0
+        self.journal_records = 0
+        self.replay()
+
+    def replay(self):
+        try:
+            with open(self.journal_path, 'rb') as journal:
+                journal.seek(self.journal_offset)
+                data = journal.read()
+        except OSError:
+            return  # Nothing was recorded since the snapshot
+        records = io.BytesIO(data)
+        replayed = 0
+        while replayed < len(data):
+            try:
+                doc_id, counts = pickle.load(records)
+            except (EOFError, pickle.UnpicklingError, ValueError):
+                break  # A record still being written, replayed next time
+            self.index.set_terms(doc_id, counts)
+            replayed = records.tell()
+            self.journal_records += 1
+            self.generation += 1
+        self.journal_offset += replayed
+
+    def record(self, doc_id, counts):
+        """Append a change to the journal, and apply it together with the ones of other processes."""
+        with self.locked():
+            self.refresh()
+            with open(self.journal_path, 'ab') as journal:
+                journal.write(pickle.dumps((doc_id, counts), protocol=pickle.HIGHEST_PROTOCOL))
+            self.replay()
+            if self.journal_records >= JOURNAL_LIMIT:
+                self.save()
+
+    def rebuild(self):
+        with self.locked():
+            self.build()
+
+    def build(self):
+        self.path = str(get_index_path())
+        documents = Document.objects.order_by('pk').values_list('pk', 'content')
+        self.index = InvertedIndex.build(documents.iterator())
+        self.generation += 1
+        self.table_checked = time.monotonic()
+        self.save()
+
+    def save(self):
+        # Written to a temporary file first, so a crash never leaves a half-written snapshot.
+        # The new snapshot comes with a new empty journal, and the old journal is removed.
+        # Called with the lock file held, so every record of the old journal was replayed.
+        token = uuid.uuid4().hex
+        tmp_path = f'{self.path}.{token}.tmp'
+        with self.index.lock:
+            saved = {'version': INDEX_VERSION, 'journal': token,
+                     'postings': self.index.postings, 'doc_terms': self.index.doc_terms}
+            with open(tmp_path, 'wb') as file:
+                pickle.dump(saved, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        old_journal = self.journal_path
+        self.snapshot_mtime = file_mtime(self.path)
+        self.journal_path = f'{self.path}.{token}.journal'
+        self.journal_offset = 0
+        self.journal_records = 0
+        if old_journal is not None:
+            try:
+                os.remove(old_journal)
+            except OSError:
+                pass
+
+index_store = IndexStore()
+
+def get_inverted_index():
+    """
+    The inverted index shared by all requests. It is loaded from its file on first use
+    and follows the changes recorded by every process. It is built from the Document
+    table when the file is missing, or when the number of documents or the highest ID
+    differs from the table.
+    """
+    return index_store.get_index()
+
+def rebuild_inverted_index():
+    """Index the whole Document table again, e.g. after changing documents with QuerySet.update()."""
+    index_store.rebuild()
+    return index_store.index
+
+def index_document(doc_id, content):
+    index_store.record(doc_id, dict(Counter(preprocess_text(content))))
+
+def unindex_document(doc_id):
+    index_store.record(doc_id, None)
 
 def create_binary_vector(doc_terms, all_terms):
     return [1 if term in doc_terms else 0 for term in all_terms]
 
+def get_documents(doc_ids):
+    """Documents of the given IDs in the same order, skipping the ones deleted meanwhile."""
+    documents = Document.objects.in_bulk(doc_ids)
+    return [documents[doc_id] for doc_id in doc_ids if doc_id in documents]
+
 def get_documents_by_term(term):
     """
     Retrieves documents that contain the specified term.
     """
-    documents = []
-    for doc in Document.objects.all():
-        content_terms = preprocess_text(doc.content)
-        if term in content_terms:
-            documents.append(doc)
-    return documents
+    return get_documents(get_inverted_index().get_postings(term))
 
 def get_non_overlapping_documents(terms):
     """
-    Combines documents for multiple terms using set union.
+    Combines documents for multiple terms using set union, in one pass over
+    their sorted postings. Documents are returned in ID order.
     """
-    combined_documents = set()
-    for term in terms:
-        documents_for_term = get_documents_by_term(term)
-        combined_documents.update(documents_for_term)
-    return list(combined_documents)
+    return get_documents(get_inverted_index().union(terms))
 
 
 
 class DocumentGraph:
-    def __init__(self):
-        self.graph = defaultdict(list)
+    """
+    Graph linking every term to the documents containing it. Its edges are the postings
+    of the inverted index, so it follows every change to the documents, including the
+    ones recorded by other processes, without keeping a copy of its own.
+    """
+    def get_edges(self, term):
+        """IDs of the documents connected to a term."""
+        return get_inverted_index().get_postings(term)
 
-    def add_edge(self, term, document):
-        """Create an edge between a term and a document."""
-        self.graph[term].append(document)
+    @property
+    def generation(self):
+        """Incremented every time the edges change."""
+        with index_store.lock:
+            get_inverted_index()
+            return index_store.generation
 
     def get_connected_documents(self, terms):
         """Retrieve all documents connected to the given terms."""
-        connected_documents = set()
-        for term in terms:
-            if term in self.graph:
-                connected_documents.update(self.graph[term])
-        return list(connected_documents)
+        return get_documents(get_inverted_index().union(terms))
 
 # Create a global graph instance
 document_graph = DocumentGraph()
 
-is_graph_built = False
-
 def preprocess_and_build_graph():
-    global is_graph_built
-    if not is_graph_built:
-        document_graph.graph.clear()  # Reset the graph
-        for doc in Document.objects.all():
-            content_terms = preprocess_text(doc.content)
-            for term in content_terms:
-                document_graph.add_edge(term, doc)
-        is_graph_built = True
-
+    # The edges come from the inverted index, which is loaded or brought up to date here
+    get_inverted_index()
+    return document_graph